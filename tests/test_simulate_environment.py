@@ -74,6 +74,53 @@ class TestInput:
         ):
             tstrait.sim_env(genetic_df=df, h2=[0.3, 0.3])
 
+        df["trait_id"] = [0, 2_000_000_000]
+        with pytest.raises(
+            ValueError, match="trait_id must be consecutive and start from 0"
+        ):
+            tstrait.sim_env(genetic_df=df, h2=[0.3, 0.3])
+
+    def test_float_trait_id(self, sample_two_trait_df):
+        df = sample_two_trait_df.astype({"trait_id": float})
+        phenotype_df = tstrait.sim_env(genetic_df=df, h2=[0.3, 0.5])
+        pd.testing.assert_series_equal(phenotype_df["trait_id"], df["trait_id"])
+
+        df["trait_id"] = [0, 0, 0.5, 0.5]
+        with pytest.raises(
+            ValueError, match="trait_id must be consecutive and start from 0"
+        ):
+            tstrait.sim_env(genetic_df=df, h2=[0.3, 0.5])
+
+    def test_env_simulator_trait_id(self, sample_two_trait_df):
+        df = sample_two_trait_df.copy()
+        with pytest.raises(
+            ValueError, match="trait_id must be consecutive and start from 0"
+        ):
+            tstrait.EnvSimulator(
+                genetic_df=df,
+                h2=[0.3, 0.5],
+                random_seed=1,
+                _trait_count=np.array([1, 1]),
+            )
+
+        with pytest.raises(
+            ValueError, match="Length of h2 must match the number of traits"
+        ):
+            tstrait.EnvSimulator(genetic_df=df, h2=0.3, random_seed=1)
+
+        df["trait_id"] = [0, 0, 2, 2]
+        with pytest.raises(
+            ValueError, match="trait_id must be consecutive and start from 0"
+        ):
+            tstrait.EnvSimulator(genetic_df=df, h2=[0.3, 0.5], random_seed=1)
+
+        for trait_id in [[0, 0, 0.5, 0.5], [0, 0, -1, -1]]:
+            df["trait_id"] = trait_id
+            with pytest.raises(
+                ValueError, match="trait_id must be consecutive and start from 0"
+            ):
+                tstrait.EnvSimulator(genetic_df=df, h2=0.3, random_seed=1)
+
     def test_bad_input_h2(self, sample_df, sample_two_trait_df):
         with pytest.raises(
             ValueError, match="Length of h2 must match the number of traits"
@@ -307,3 +354,103 @@ class Test_KSTest:
             "norm",
             (0, sd),
         )
+
+
+class TestTraitVar:
+    """Check that the per-trait variance used to simulate environmental noise matches
+    the pandas groupby variance for both sorted and unsorted trait IDs.
+    """
+
+    @pytest.mark.parametrize("sort", [True, False])
+    def test_trait_var(self, sort):
+        rng = np.random.default_rng(1)
+        trait_id = np.repeat(np.arange(3), [5, 3, 7])
+        if not sort:
+            trait_id = rng.permutation(trait_id)
+        df = pd.DataFrame(
+            {
+                "trait_id": trait_id,
+                "individual_id": np.arange(len(trait_id)),
+                "genetic_value": rng.normal(loc=100, scale=1, size=len(trait_id)),
+            }
+        )
+        simulator = tstrait.EnvSimulator(
+            genetic_df=df, h2=np.ones(3) * 0.3, random_seed=1
+        )
+        np.testing.assert_allclose(
+            simulator._trait_var(),
+            df.groupby("trait_id")["genetic_value"].var().to_numpy(),
+        )
+
+    def test_single_trait(self, sample_df):
+        simulator = tstrait.EnvSimulator(genetic_df=sample_df, h2=0.3, random_seed=1)
+        np.testing.assert_allclose(simulator._trait_var(), [0.5])
+        df = simulator.sim_environment()
+        assert len(df) == len(sample_df)
+
+
+class TestDtype:
+    """Check that the environmental noise can be simulated in single precision, and
+    that the trait ID column keeps the dtype of the input.
+    """
+
+    @pytest.mark.parametrize("dtype", [np.int64, np.uint8, "Int64"])
+    def test_trait_id_dtype(self, sample_two_trait_df, dtype):
+        df = sample_two_trait_df.astype({"trait_id": dtype})
+        phenotype_df = tstrait.sim_env(genetic_df=df, h2=[0.3, 0.5], random_seed=1)
+        pd.testing.assert_series_equal(phenotype_df["trait_id"], df["trait_id"])
+
+    def test_genetic_value_dtype(self, sample_df):
+        phenotype_df = tstrait.sim_env(genetic_df=sample_df, h2=0.3, random_seed=1)
+        pd.testing.assert_series_equal(
+            phenotype_df["genetic_value"], sample_df["genetic_value"]
+        )
+
+    def test_float32(self, sample_two_trait_df):
+        simulator = tstrait.EnvSimulator(
+            genetic_df=sample_two_trait_df,
+            h2=[0.3, 1],
+            random_seed=1,
+            dtype=np.float32,
+        )
+        df = simulator.sim_environment()
+        assert df["environmental_noise"].dtype == np.float32
+        np.testing.assert_equal(df["environmental_noise"][2:], np.zeros(2))
+        np.testing.assert_allclose(
+            df["phenotype"], df["genetic_value"] + df["environmental_noise"]
+        )
+
+
+class TestParallel:
+    """Check that drawing the environmental noise of each trait in a separate thread
+    gives the same result as drawing them serially.
+    """
+
+    @pytest.mark.parametrize("sort", [True, False])
+    def test_parallel(self, sample_two_trait_df, monkeypatch, sort):
+        df = sample_two_trait_df
+        if not sort:
+            df = df.iloc[[0, 2, 3, 1]]
+        serial_df = tstrait.sim_env(genetic_df=df, h2=[0.3, 0.5], random_seed=1)
+        monkeypatch.setattr(tstrait.simulate_environment, "_PARALLEL_THRESHOLD", 0)
+        parallel_df = tstrait.sim_env(genetic_df=df, h2=[0.3, 0.5], random_seed=1)
+        pd.testing.assert_frame_equal(serial_df, parallel_df)
+
+    def test_single_trait_stream(self, sample_df):
+        """A single trait uses the random seed directly, without spawning"""
+        h2 = 0.3
+        env_std = np.sqrt((1 - h2) / h2 * np.var(sample_df["genetic_value"], ddof=1))
+        expected = np.random.default_rng(1).normal(scale=env_std, size=len(sample_df))
+        for random_seed in [1, np.random.default_rng(1)]:
+            df = tstrait.sim_env(genetic_df=sample_df, h2=h2, random_seed=random_seed)
+            np.testing.assert_allclose(df["environmental_noise"], expected)
+
+    def test_unsorted(self, sample_two_trait_df):
+        sorted_df = tstrait.sim_env(
+            genetic_df=sample_two_trait_df, h2=[0.3, 0.5], random_seed=1
+        )
+        order = [0, 2, 3, 1]
+        unsorted_df = tstrait.sim_env(
+            genetic_df=sample_two_trait_df.iloc[order], h2=[0.3, 0.5], random_seed=1
+        )
+        pd.testing.assert_frame_equal(sorted_df.iloc[order], unsorted_df)
@@ -36,12 +36,13 @@ class GeneticResult:
     genetic: pd.DataFrame
 
 
-@numba.njit
+@numba.njit(cache=True)
 def _traversal_genotype(
     nodes_individual,
     left_child_array,
     right_sib_array,
     stack,
+    stack_size,
     has_mutation,
     num_individuals,
     num_nodes,
@@ -49,12 +50,15 @@ def _traversal_genotype(
     """
     Numba to speed up the tree traversal algorithm to determine the genotype of
     individuals.
-    Stack has to be Typed List in numba to use numba.
+    The stack is a preallocated int32 array whose first `stack_size` entries are
+    the nodes to start the traversal from. Every node is pushed at most once, so
+    an array of length `num_nodes + 1` is large enough.
     """
 
     genotype = np.zeros(num_individuals)
-    while len(stack) > 0:
-        parent_node_id = stack.pop()
+    while stack_size > 0:
+        stack_size -= 1
+        parent_node_id = stack[stack_size]
         if parent_node_id == num_nodes:
             individual_id = -1
         else:
@@ -64,7 +68,8 @@ def _traversal_genotype(
         child_node_id = left_child_array[parent_node_id]
         while child_node_id != -1:
             if not has_mutation[child_node_id]:
-                stack.append(child_node_id)
+                stack[stack_size] = child_node_id
+                stack_size += 1
             child_node_id = right_sib_array[child_node_id]
 
     return genotype
@@ -130,12 +135,14 @@ class GeneticValue:
         for m in site.mutations:
             state_transitions[m.node] = m.derived_state
             has_mutation[m.node] = True
-        stack = numba.typed.List()
+        stack = np.zeros(num_nodes + 1, dtype=np.int32)
+        stack_size = 0
         for node, state in state_transitions.items():
             if state == causal_state:
-                stack.append(node)
+                stack[stack_size] = node
+                stack_size += 1
 
-        if len(stack) == 0:  # pragma: no cover
+        if stack_size == 0:  # pragma: no cover
             genotype = np.zeros(self.ts.num_individuals)
         else:
             genotype = _traversal_genotype(
@@ -143,6 +150,7 @@ class GeneticValue:
                 left_child_array=tree.left_child_array,
                 right_sib_array=tree.right_sib_array,
                 stack=stack,
+                stack_size=stack_size,
                 has_mutation=has_mutation,
                 num_individuals=self.ts.num_individuals,
                 num_nodes=num_nodes,
@@ -1,9 +1,85 @@
-import numbers
+import concurrent.futures
+import os
 
+import numba
 import numpy as np
+import pandas as pd
 
 from .base import _check_dataframe
 
+# Minimum number of rows before the environmental noise of different traits is
+# drawn in separate threads. Below this, the thread pool overhead dominates.
+_PARALLEL_THRESHOLD = 100_000
+
+# The numba kernels below are only used when the trait IDs of a multi-trait input
+# are not sorted. They are compiled on first use, which takes about a second. The
+# compiled code is cached on disk, but loading it still adds a few hundred
+# milliseconds to the first such call in each process. Sorted and single-trait
+# inputs, such as the output of sim_genetic, only use NumPy.
+
+
+@numba.njit(cache=True)
+def _trait_sum_sq(trait_id, genetic_value, num_trait):  # pragma: no cover
+    """
+    Numba to compute the sum of squared deviations from the mean of genetic values
+    of each trait in a single pass over unsorted trait IDs. The values are shifted
+    by the first genetic value of each trait, which avoids the cancellation of the
+    naive sum of squares without a division per element.
+    """
+    shift = np.full(num_trait, np.nan)
+    total = np.zeros(num_trait)
+    total_sq = np.zeros(num_trait)
+    for i in range(len(trait_id)):
+        j = trait_id[i]
+        value = genetic_value[i]
+        if np.isnan(shift[j]):
+            shift[j] = value
+        delta = value - shift[j]
+        total[j] += delta
+        total_sq[j] += delta * delta
+
+    return total, total_sq
+
+
+@numba.njit(cache=True)
+def _scatter_trait_blocks(trait_id, block_values, offsets, values):  # pragma: no cover
+    """
+    Numba to scatter values that are stored in contiguous blocks of each trait back
+    to the rows of unsorted trait IDs. Rows of a trait take the values of its block
+    in order, which is the inverse of a stable counting sort and takes O(N) time.
+    """
+    position = offsets.copy()
+    for i in range(len(trait_id)):
+        j = trait_id[i]
+        values[i] = block_values[position[j]]
+        position[j] += 1
+
+
+def _check_trait_id(trait_id):
+    """Convert the trait ID column to an integer array and check that the IDs are
+    consecutive and start from 0. Trait IDs that are stored as integral floats are
+    accepted. Returns the trait ID array and the number of individuals of each trait.
+    """
+    if pd.api.types.is_integer_dtype(trait_id):
+        trait_id = trait_id.to_numpy(dtype=np.int64)
+    else:
+        trait_id = trait_id.to_numpy(dtype=np.float64)
+        if not np.all(np.mod(trait_id, 1) == 0):
+            raise ValueError("trait_id must be consecutive and start from 0")
+        trait_id = trait_id.astype(np.int64)
+
+    # Consecutive trait IDs starting from 0 are smaller than the number of rows,
+    # which bounds the size of the bincount output.
+    if trait_id.min() != 0 or trait_id.max() >= len(trait_id):
+        raise ValueError("trait_id must be consecutive and start from 0")
+
+    trait_count = np.bincount(trait_id)
+
+    if trait_count.min() == 0:
+        raise ValueError("trait_id must be consecutive and start from 0")
+
+    return trait_id, trait_count
+
 
 class EnvSimulator:
     """Simulator class to simulate environmental noise of individuals.
@@ -17,35 +93,135 @@ class EnvSimulator:
         Narrow-sense heritability.
     random_seed : int
         The random seed.
+    dtype : numpy.dtype, default numpy.float64
+        Floating point type used to draw and scale environmental noise. Setting it
+        to numpy.float32 halves the memory traffic of the noise kernel.
     """
 
-    def __init__(self, genetic_df, h2, random_seed):
-        self.genetic_df = genetic_df[["trait_id", "individual_id", "genetic_value"]]
-        self.h2 = h2
+    def __init__(
+        self, genetic_df, h2, random_seed, dtype=np.float64, _trait_count=None
+    ):
+        # The columns are held as aligned numpy arrays. Trait IDs used by the
+        # per-trait kernels are stored as int32, as the number of traits is small,
+        # and genetic values as float64, while the caller's trait ID and genetic
+        # value columns are kept for the output. The output columns are copied
+        # from `genetic_df` exactly once.
+        if _trait_count is None:
+            trait_id, _trait_count = _check_trait_id(genetic_df["trait_id"])
+            self.trait_id = trait_id.astype(np.int32)
+        else:
+            self.trait_id = genetic_df["trait_id"].to_numpy(dtype=np.int32)
+        self.trait_id_column = genetic_df["trait_id"].array.copy()
+        self.individual_id = genetic_df["individual_id"].to_numpy(copy=True)
+        self.genetic_value = genetic_df["genetic_value"].to_numpy(dtype=np.float64)
+        self.genetic_value_column = genetic_df["genetic_value"].array.copy()
+        self.index = genetic_df.index
+        self.h2 = np.asarray(h2, dtype=np.float64).reshape(-1)
+        # The number of individuals of each trait is passed by sim_env, which has
+        # already computed it to validate the trait IDs.
+        trait_count = _trait_count
+        if len(trait_count) != len(self.h2):
+            raise ValueError("Length of h2 must match the number of traits")
+        if trait_count.sum() != len(self.trait_id) or trait_count.min() == 0:
+            raise ValueError("trait_id must be consecutive and start from 0")
+        self.trait_count = trait_count
+        self.is_sorted = len(trait_count) == 1 or bool(
+            np.all(self.trait_id[1:] >= self.trait_id[:-1])
+        )
+        self.dtype = dtype
         self.rng = np.random.default_rng(random_seed)
 
     def _sim_env(self, var, h2):
-        """Simulate environmental noise based on variance and narrow-sense
-        heritability
+        """Simulate environmental noise based on the variance of genetic values and
+        narrow-sense heritability of each trait. When there are multiple traits, the
+        noise of each trait is drawn into a contiguous block from its own random
+        number generator spawned from `self.rng`, so the traits can be simulated in
+        separate threads and the result does not depend on the number of threads.
         """
-        env_std = np.sqrt((1 - h2) / h2 * var)
-        env_noise = self.rng.normal(loc=0.0, scale=env_std)
+        ratio = np.divide(1 - h2, h2, out=np.zeros_like(h2), where=h2 > 0)
+        env_std = np.sqrt(ratio * var)
+        counts = self.trait_count
+        offsets = np.cumsum(counts) - counts
+        num_trait = len(counts)
+        if num_trait == 1:
+            rngs = [self.rng]
+        else:
+            seed_seq = np.random.SeedSequence(
+                self.rng.integers(2**32, size=4, dtype=np.uint64)
+            )
+            rngs = [np.random.default_rng(seed) for seed in seed_seq.spawn(num_trait)]
+        env_noise = np.empty(len(self.trait_id), dtype=self.dtype)
+
+        def sim_block(trait_id):
+            block = env_noise[offsets[trait_id] : offsets[trait_id] + counts[trait_id]]
+            rngs[trait_id].standard_normal(out=block, dtype=self.dtype)
+            block *= env_std[trait_id]
+
+        if num_trait > 1 and len(env_noise) >= _PARALLEL_THRESHOLD:
+            max_workers = min(num_trait, os.cpu_count() or 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+                list(executor.map(sim_block, range(num_trait)))
+        else:
+            for trait_id in range(num_trait):
+                sim_block(trait_id)
+
+        if not self.is_sorted:
+            # The blocks are in trait order, so scatter them back to the rows
+            block_noise = env_noise
+            env_noise = np.empty_like(block_noise)
+            _scatter_trait_blocks(self.trait_id, block_noise, offsets, env_noise)
 
         return env_noise
 
+    def _trait_var(self):
+        """Compute the sample variance (ddof=1) of genetic values of each trait
+        without building a pandas groupby object. When the trait IDs are sorted,
+        which is the case for the output of :func:`sim_genetic`, each trait is a
+        contiguous block and the sums are streamed with `np.add.reduceat`.
+        Otherwise, they are accumulated in a single pass by `_trait_sum_sq`.
+        """
+        genetic_value = self.genetic_value
+        counts = self.trait_count
+        if len(counts) == 1:
+            # A single trait is the most common case, and it does not need any
+            # per-trait reduction.
+            deviation = genetic_value - genetic_value.mean()
+            sum_sq = np.array([np.dot(deviation, deviation)])
+        elif self.is_sorted:
+            offsets = np.cumsum(counts) - counts
+            mean = np.add.reduceat(genetic_value, offsets) / counts
+            # The squared deviations are computed in place in the buffer holding
+            # the broadcast means, so only one temporary of length N is allocated.
+            deviation = np.repeat(mean, counts)
+            np.subtract(genetic_value, deviation, out=deviation)
+            np.square(deviation, out=deviation)
+            sum_sq = np.add.reduceat(deviation, offsets)
+        else:
+            total, total_sq = _trait_sum_sq(self.trait_id, genetic_value, len(counts))
+            sum_sq = total_sq - total * total / counts
+        with np.errstate(divide="ignore", invalid="ignore"):
+            var = sum_sq / (counts - 1)
+
+        return var
+
     def sim_environment(self):
         """Simulate environmental values based on genetic values of individuals and
         narrow-sense heritability
         """
-        df = self.genetic_df.copy()
-        h2_array = np.take(self.h2, self.genetic_df.trait_id)
-
-        grouped = df.groupby("trait_id", sort=False)["genetic_value"]
-        var_array = grouped.transform("var")
-
-        df["environmental_noise"] = self._sim_env(var_array, h2_array)
-
-        df["phenotype"] = df["genetic_value"] + df["environmental_noise"]
+        genetic_value = self.genetic_value
+        env_noise = self._sim_env(self._trait_var(), self.h2)
+
+        df = pd.DataFrame(
+            {
+                "trait_id": self.trait_id_column,
+                "individual_id": self.individual_id,
+                "genetic_value": self.genetic_value_column,
+                "environmental_noise": env_noise,
+                "phenotype": genetic_value + env_noise,
+            },
+            index=self.index,
+            copy=False,
+        )
 
         return df
 
@@ -107,28 +283,27 @@ def sim_env(genetic_df, h2, random_seed=None):
     --------
     See :ref:`env_simulation` for worked examples.
     """
-    genetic_df = _check_dataframe(
+    # The column subset returned by _check_dataframe is not used, as EnvSimulator
+    # only reads the columns it needs by name.
+    _check_dataframe(
         genetic_df, ["trait_id", "individual_id", "genetic_value"], "genetic_df"
     )
 
-    trait_id = genetic_df["trait_id"].unique()
-
-    if np.min(trait_id) != 0 or np.max(trait_id) != len(trait_id) - 1:
-        raise ValueError("trait_id must be consecutive and start from 0")
+    _, trait_count = _check_trait_id(genetic_df["trait_id"])
 
-    if isinstance(h2, numbers.Real):
-        h2 = np.array([h2])
+    h2 = np.asarray(h2, dtype=np.float64).reshape(-1)
 
-    if len(h2) != len(trait_id):
+    if len(h2) != len(trait_count):
         raise ValueError("Length of h2 must match the number of traits")
 
-    if np.min(h2) <= 0 or np.max(h2) > 1:
+    if h2.min() <= 0 or h2.max() > 1:
         raise ValueError("Narrow-sense heritability must be 0 < h2 <= 1")
 
     simulator = EnvSimulator(
         genetic_df=genetic_df,
         h2=h2,
         random_seed=random_seed,
+        _trait_count=trait_count,
     )
 
     phenotype_df = simulator.sim_environment()